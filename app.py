@@ -1,44 +1,269 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+import orjson
 import streamlit as st
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from urllib3.util.retry import Retry
+
+from nutrients import NUTRIENT_IDS, NUTRIENT_NUMBERS
 
 # Define API key
 API_KEY = st.secrets["USDA_API_KEY"]
 
-# Nutrient mapping
-NUTRIENT_IDS = {
-    1008: "Calories",
-    1003: "Protein (g)",
-    1004: "Total Fat (g)",
-    1005: "Carbohydrates (g)",
-    1093: "Sodium (mg)",
-    1092: "Potassium (mg)",
-    1091: "Phosphorus (mg)",
-    1051: "Water (g)"
-}
-
-# Search USDA Food Database
+# Max USDA requests in flight at once
+MAX_CONCURRENCY = 8
+
+# Shared HTTP session: keep-alive connection pool plus retries on server errors.
+# Cached as a resource so the pool survives reruns and is shared across users.
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip"})
+    session.mount("https://", HTTPAdapter(
+        # The session is shared by every user, so leave room for several concurrent analyses
+        pool_maxsize=2 * MAX_CONCURRENCY,
+        # 429 is USDA's hourly rate limit, so a quick retry cannot succeed. The bulk POST /foods is a
+        # read, so it is retried like the GETs. Once retries run out, the last response is returned
+        # rather than raised as RetryError.
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+            raise_on_status=False
+        )
+    ))
+    return session
+
+LABELS_BY_NUMBER = {str(NUTRIENT_NUMBERS[nid]): label for nid, label in NUTRIENT_IDS.items()}
+NUTRIENT_LABELS = list(NUTRIENT_IDS.values())
+
+# Optional local mirror of the USDA CSVs, built by build_food_db.py. A mirror that can't
+# be queried (corrupt, LFS pointer, old schema, no FTS5) counts as a miss.
+FOOD_DB_PATH = Path(__file__).with_name("foods.sqlite")
+
+# Keyed on the file's inode and mtime; max_entries=1 lets the connection to a replaced file go
+@st.cache_resource(max_entries=1)
+def _connect_food_db(inode, mtime):
+    return sqlite3.connect(f"file:{FOOD_DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+
+# Connection to the mirror, or None while it hasn't been built. build_food_db.py swaps the
+# file in by rename, so a first build or a rebuild both take effect without a restart.
+def get_food_db():
+    try:
+        stat = FOOD_DB_PATH.stat()
+    except FileNotFoundError:
+        return None
+    return _connect_food_db(stat.st_ino, stat.st_mtime)
+
+# Search the local mirror for foods matching every word of the query
+def search_local_foods(query, max_results=1):
+    db = get_food_db()
+    terms = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+    if db is None or not terms:
+        return []
+    try:
+        rows = db.execute(
+            "SELECT rowid, description FROM foods_fts WHERE foods_fts MATCH ? ORDER BY rank LIMIT ?",
+            (terms, max_results)
+        ).fetchall()
+    except sqlite3.Error:
+        return []
+    return [{"fdcId": fdc_id, "description": description} for fdc_id, description in rows]
+
+# Nutrients per 100g from the local mirror, for the foods it has
+def extract_local_nutrients(fdc_ids):
+    db = get_food_db()
+    if db is None or not fdc_ids:
+        return {}
+    placeholders = ",".join("?" * len(fdc_ids))
+    try:
+        rows = db.execute(
+            f"SELECT fdc_id, nutrient_id, amount FROM food_nutrients WHERE fdc_id IN ({placeholders})",
+            fdc_ids
+        ).fetchall()
+    except sqlite3.Error:
+        return {}
+    results = {}
+    for fdc_id, nid, amount in rows:
+        label = NUTRIENT_IDS.get(nid)
+        if label is not None:
+            results.setdefault(fdc_id, {})[label] = amount
+    return results
+
+# On-disk cache of USDA API results, so common foods survive app restarts
+CACHE_DB_PATH = Path(__file__).with_name("cache.db")
+CACHE_TTL = 60 * 60 * 24 * 30
+
+# The cache is optional: any SQLite or decode failure counts as a miss or a skipped write
+CACHE_ERRORS = (sqlite3.Error, orjson.JSONDecodeError)
+
+# Read unexpired cache entries for the given keys
+def load_cached(keys):
+    if not keys:
+        return {}
+    placeholders = ",".join("?" * len(keys))
+    try:
+        with closing(sqlite3.connect(CACHE_DB_PATH, timeout=5)) as db:
+            rows = db.execute(
+                f"SELECT key, payload FROM responses WHERE key IN ({placeholders}) AND fetched_at > ?",
+                (*keys, time.time() - CACHE_TTL)
+            ).fetchall()
+        return {key: orjson.loads(payload) for key, payload in rows}
+    except CACHE_ERRORS:
+        return {}
+
+# Write {key: value} entries to the cache and drop expired ones
+def store_cached(entries):
+    if not entries:
+        return
+    now = time.time()
+    try:
+        with closing(sqlite3.connect(CACHE_DB_PATH, timeout=5)) as db, db:
+            db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, fetched_at REAL, payload BLOB)")
+            db.execute("DELETE FROM responses WHERE fetched_at <= ?", (now - CACHE_TTL,))
+            db.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                [(key, now, orjson.dumps(value)) for key, value in entries.items()]
+            )
+    except CACHE_ERRORS:
+        pass
+
+def load_cached_nutrients(fdc_ids):
+    cached = load_cached([f"food:{fid}" for fid in fdc_ids])
+    return {fid: cached[f"food:{fid}"] for fid in fdc_ids if f"food:{fid}" in cached}
+
+def store_cached_nutrients(details):
+    store_cached({f"food:{fid}": nutrients for fid, nutrients in details.items() if nutrients})
+
+# Search USDA Food Database, local mirror first
 def search_foods(query, max_results=1):
+    # Normalize so "Banana" and " banana " share one cache entry
+    query = query.strip().lower()
+    local = search_local_foods(query, max_results)
+    if local:
+        return local
+    try:
+        return _search_foods(query, max_results)
+    except requests.RequestException:
+        return []
+
+# Cached USDA search; raises on failure so errors are never memoized
+@st.cache_data(ttl=60 * 60 * 24, max_entries=4096, show_spinner=False)
+def _search_foods(query, max_results):
+    key = f"search:{max_results}:{query}"
+    cached = load_cached([key])
+    if key in cached:
+        return cached[key]
     url = "https://api.nal.usda.gov/fdc/v1/foods/search"
     params = {"api_key": API_KEY, "query": query, "pageSize": max_results}
-    res = requests.get(url, params=params)
-    return res.json().get("foods", []) if res.status_code == 200 else []
+    res = get_session().get(url, params=params, timeout=5)
+    res.raise_for_status()
+    # Keep only what callers use; each hit otherwise carries its full nutrient list
+    foods = [{"fdcId": f["fdcId"], "description": f["description"]} for f in orjson.loads(res.content).get("foods", [])]
+    store_cached({key: foods})
+    return foods
 
-# Extract nutrients per 100g
+# Pick our nutrients out of an abridged-format food record
+def parse_nutrients(food):
+    return {
+        label: n.get("amount")
+        for n in food.get("foodNutrients", [])
+        if (label := LABELS_BY_NUMBER.get(str(n.get("number")))) is not None
+    }
+
+# Extract nutrients per 100g; raises on failure so errors are never memoized
+@st.cache_data(ttl=60 * 60 * 24, max_entries=4096, show_spinner=False)
 def extract_nutrients(fdc_id):
     url = f"https://api.nal.usda.gov/fdc/v1/food/{fdc_id}"
+    params = {
+        "api_key": API_KEY,
+        "format": "abridged",
+        "nutrients": ",".join(map(str, NUTRIENT_NUMBERS.values()))
+    }
+    res = get_session().get(url, params=params, timeout=5)
+    res.raise_for_status()
+    return parse_nutrients(orjson.loads(res.content))
+
+# Extract nutrients per 100g for several foods in one request; raises on failure like above
+@st.cache_data(ttl=60 * 60 * 24, max_entries=4096, show_spinner=False)
+def extract_nutrients_bulk(fdc_ids):
+    url = "https://api.nal.usda.gov/fdc/v1/foods"
     params = {"api_key": API_KEY}
-    res = requests.get(url, params=params)
-    if res.status_code != 200:
-        return {}
-    data = res.json()
-    nutrients = data.get("foodNutrients", [])
-    result = {}
-    for n in nutrients:
-        nid = n.get("nutrient", {}).get("id")
-        if nid in NUTRIENT_IDS:
-            result[NUTRIENT_IDS[nid]] = n.get("amount")
-    return result
+    body = {"fdcIds": list(fdc_ids), "format": "abridged", "nutrients": list(NUTRIENT_NUMBERS.values())}
+    res = get_session().post(url, params=params, json=body, timeout=5)
+    res.raise_for_status()
+    return {food["fdcId"]: parse_nutrients(food) for food in orjson.loads(res.content)}
+
+# Max fdcIds accepted by one bulk request
+BULK_SIZE = 20
+
+# Failures that only cost the affected item its results, not the whole batch
+LOOKUP_ERRORS = (requests.RequestException, ValueError, KeyError)
+
+# Run a blocking lookup on a worker thread attached to this script run,
+# so the st.cache_* helpers behave there as they do on the script thread
+async def _run_in_thread(fn, *args):
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+
+    return await asyncio.to_thread(run)
+
+async def _search_async(sem, query):
+    async with sem:
+        try:
+            return await _run_in_thread(search_foods, query)
+        except LOOKUP_ERRORS:
+            return []
+
+async def _extract_async(sem, fdc_id):
+    async with sem:
+        try:
+            return await _run_in_thread(extract_nutrients, fdc_id)
+        except LOOKUP_ERRORS:
+            return {}
+
+async def _extract_bulk_async(sem, fdc_ids):
+    async with sem:
+        try:
+            return await _run_in_thread(extract_nutrients_bulk, fdc_ids)
+        except LOOKUP_ERRORS:
+            return {}
+
+# Look up all items concurrently: one wave of searches, then bulk detail fetches
+async def analyze_batch(items):
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    # Search each distinct item once; repeats (ignoring case) reuse the same result
+    keys = [item.strip().lower() for item in items]
+    unique = list(dict.fromkeys(keys))
+    searches_by_key = dict(zip(unique, await asyncio.gather(*[_search_async(sem, key) for key in unique])))
+    searches = [searches_by_key[key] for key in keys]
+    fdc_ids = tuple(dict.fromkeys(matches[0]["fdcId"] for matches in searches if matches))
+    details = extract_local_nutrients(fdc_ids)
+    details.update(load_cached_nutrients([fid for fid in fdc_ids if fid not in details]))
+    remote_ids = tuple(fid for fid in fdc_ids if fid not in details)
+    chunks = [remote_ids[i:i + BULK_SIZE] for i in range(0, len(remote_ids), BULK_SIZE)]
+    for found in await asyncio.gather(*[_extract_bulk_async(sem, chunk) for chunk in chunks]):
+        details.update(found)
+
+    # Fall back to single-food lookups for anything the bulk request didn't return
+    missing = [fid for fid in fdc_ids if fid not in details]
+    fallback = await asyncio.gather(*[_extract_async(sem, fid) for fid in missing])
+    details.update(zip(missing, fallback))
+    store_cached_nutrients({fid: details[fid] for fid in remote_ids})
+
+    return [(item, matches, details[matches[0]["fdcId"]] if matches else {}) for item, matches in zip(items, searches)]
 
 # App UI
 st.set_page_config(page_title="Food Nutrient Analyzer", layout="wide")
@@ -46,20 +271,20 @@ st.title("🥗 Nutrient Analyzer (Per 100g)")
 st.markdown("Enter food names (comma-separated) and get key nutrient content per 100 grams.")
 
 # Input
-query = st.text_input("Enter food items", "banana, white bread, milk")
+with st.form("analyze_form"):
+    query = st.text_input("Enter food items", "banana, white bread, milk")
+    submitted = st.form_submit_button("Analyze")
 
-if st.button("Analyze"):
+if submitted:
     if query.strip() == "":
         st.warning("Please enter at least one food item.")
     else:
         items = [i.strip() for i in query.split(",") if i.strip()]
         records = []
 
-        for item in items:
-            matches = search_foods(item)
+        for item, matches, nutrients in asyncio.run(analyze_batch(items)):
             if matches:
                 food_desc = matches[0]["description"]
-                nutrients = extract_nutrients(matches[0]["fdcId"])
                 if nutrients:
                     row = {"Food": food_desc}
                     row.update(nutrients)
@@ -70,13 +295,14 @@ if st.button("Analyze"):
                 st.warning(f"No results for: {item}")
 
         if records:
-            df = pd.DataFrame(records)
+            df = pd.DataFrame.from_records(records, columns=["Food", *NUTRIENT_LABELS])
             st.subheader("📋 Nutrient Content per 100g")
             st.dataframe(df)
 
             # Totals
-            summary_cols = [col for col in df.columns if col != "Food"]
-            total = df[summary_cols].sum(numeric_only=True).to_frame(name="Total per Meal")
+            nutrient_df = df[NUTRIENT_LABELS].apply(pd.to_numeric, errors="coerce")
+            # min_count=1 keeps a nutrient no food reported as unknown rather than 0
+            total = nutrient_df.sum(min_count=1).to_frame(name="Total per Meal")
             st.subheader("📊 Total Nutrients for All Items")
             st.dataframe(total)
 
@@ -0,0 +1,58 @@
+"""Build foods.sqlite, the local USDA mirror app.py searches before calling the API.
+
+Download and unzip the CSV release from the USDA FoodData Central
+download page, then run:
+
+    python build_food_db.py <path to the unzipped CSV folder>
+"""
+import csv
+import sqlite3
+import sys
+from pathlib import Path
+
+from nutrients import NUTRIENT_IDS
+
+# Generic foods only; branded products would grow the database to gigabytes
+DATA_TYPES = {"foundation_food", "sr_legacy_food", "survey_fndds_food"}
+
+DB_PATH = Path(__file__).with_name("foods.sqlite")
+
+
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
+
+def build(csv_dir):
+    csv_dir = Path(csv_dir)
+    foods = {
+        int(row["fdc_id"]): row["description"]
+        for row in read_rows(csv_dir / "food.csv")
+        if row["data_type"] in DATA_TYPES
+    }
+    nutrients = (
+        (fdc_id, nutrient_id, float(row["amount"]))
+        for row in read_rows(csv_dir / "food_nutrient.csv")
+        if (fdc_id := int(row["fdc_id"])) in foods
+        and (nutrient_id := int(row["nutrient_id"])) in NUTRIENT_IDS
+        and row["amount"]
+    )
+
+    tmp_path = DB_PATH.with_suffix(".tmp")
+    tmp_path.unlink(missing_ok=True)
+    db = sqlite3.connect(tmp_path)
+    with db:
+        db.execute("CREATE VIRTUAL TABLE foods_fts USING fts5(description, tokenize='porter unicode61')")
+        db.executemany("INSERT INTO foods_fts (rowid, description) VALUES (?, ?)", foods.items())
+        db.execute("CREATE TABLE food_nutrients (fdc_id INTEGER, nutrient_id INTEGER, amount REAL)")
+        db.executemany("INSERT INTO food_nutrients VALUES (?, ?, ?)", nutrients)
+        db.execute("CREATE INDEX food_nutrients_fdc_id ON food_nutrients (fdc_id)")
+    db.close()
+    tmp_path.replace(DB_PATH)
+    print(f"Wrote {len(foods)} foods to {DB_PATH}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    build(sys.argv[1])
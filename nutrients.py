@@ -0,0 +1,25 @@
+"""Nutrients the app reports, shared by app.py and build_food_db.py."""
+
+# Nutrient mapping
+NUTRIENT_IDS = {
+    1008: "Calories",
+    1003: "Protein (g)",
+    1004: "Total Fat (g)",
+    1005: "Carbohydrates (g)",
+    1093: "Sodium (mg)",
+    1092: "Potassium (mg)",
+    1091: "Phosphorus (mg)",
+    1051: "Water (g)"
+}
+
+# USDA nutrient numbers for the IDs above (used by the abridged format and the nutrients filter)
+NUTRIENT_NUMBERS = {
+    1008: 208,
+    1003: 203,
+    1004: 204,
+    1005: 205,
+    1093: 307,
+    1092: 306,
+    1091: 305,
+    1051: 255
+}